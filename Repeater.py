@@ -1,9 +1,16 @@
+import time
+STARTUP_BEGIN = time.perf_counter()
+
 import requests
-import boto3
 import json
 import csv
 import datetime
 import logging
+import argparse
+import contextlib
+import functools
+import re
+import socket
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import os
@@ -15,12 +22,25 @@ SPLUNK_TOKEN  = os.getenv("splunk_token")
 TANIUM_SERVER = os.getenv("tanium_server")
 TANIUM_TOKEN  = os.getenv("tanium_token")
 CONFIG_FILE = "config.txt"
+CONFIG_FIELDNAMES = ['Name', 'Destination Type', 'File Location', 'Frequency', 'Last Run', 'Tanium Type', 'Component Name', 'File Format', 'Bucket Name', 'Flatten', 'Overwrite']
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 # Adjust library warnings to reduce noise
 requests.packages.urllib3.disable_warnings()
-boto3.compat.filter_python_deprecation_warnings()
 logging.basicConfig(filename='example.log', level=logging.DEBUG)
 
+# Registries of data sources (keyed by Tanium Type), file writers (keyed by Tanium Type and File Format)
+# and sinks (keyed by Destination Type). Heavy backends such as boto3 are only imported and set up
+# the first time a due job dispatches to a sink that needs them.
+SOURCES      = {}
+FILE_WRITERS = {}
+SINKS        = {}
+SINK_SETUP   = {}
+_initialized_sinks = set()
+
+# Stage timings and the largest allocation snapshot of the job being profiled, None when profiling is off
+PROFILE_STATE = None
+
 class JobConfig:
     def __init__(self, config:dict):
         """Takes a row from the csv file and makes it into an object for easy referencing between functions"""
@@ -78,8 +98,77 @@ def log(level: str , message: str) -> None:
     if level == "error":
         logging.error(f"{datetime.now()} {message}")
 
+def register_source(tanium_type: str):
+    """Decorator that registers a function as the data source for a Tanium Type"""
+    def decorator(func):
+        SOURCES[tanium_type] = func
+        return func
+    return decorator
+
+def register_file_writer(tanium_type: str, file_format: str):
+    """Decorator that registers a function as the file writer for a Tanium Type and File Format"""
+    def decorator(func):
+        FILE_WRITERS[(tanium_type, file_format)] = func
+        return func
+    return decorator
+
+def register_sink(destination_type: str, setup=None):
+    """Decorator that registers a function as the sink for a Destination Type, with an optional one time setup function"""
+    def decorator(func):
+        SINKS[destination_type] = func
+        if setup:
+            SINK_SETUP[destination_type] = setup
+        return func
+    return decorator
+
+def init_sink(destination_type: str) -> None:
+    """Runs the setup function of a sink the first time it is used"""
+    if destination_type in _initialized_sinks:
+        return
+
+    setup = SINK_SETUP.get(destination_type)
+    if setup:
+        log("info", f"initializing backend for destination type: {destination_type}")
+        setup()
+
+    _initialized_sinks.add(destination_type)
+
+def timed_stage(func):
+    """Decorator that records the time spent in a routing stage while a job is being profiled, and snapshots allocations at the end of the outermost stage while its data is still alive"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if PROFILE_STATE is None:
+            return func(*args, **kwargs)
+
+        import tracemalloc
+        PROFILE_STATE['depth'] += 1
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings = PROFILE_STATE['timings']
+            timings[func.__name__] = timings.get(func.__name__, 0) + time.perf_counter() - start
+            PROFILE_STATE['depth'] -= 1
+
+            # Nested stages such as generate_file inside export_data don't snapshot, so the snapshot cost never lands
+            # inside an enclosing stage's timing. The profiler is paused so it stays out of the cumulative times too
+            traced = tracemalloc.get_traced_memory()[0]
+            if PROFILE_STATE['depth'] == 0 and traced > PROFILE_STATE['snapshot_size']:
+                PROFILE_STATE['profiler'].disable()
+                snapshot_start = time.perf_counter()
+
+                PROFILE_STATE['snapshot']       = tracemalloc.take_snapshot()
+                PROFILE_STATE['snapshot_size']  = traced
+                PROFILE_STATE['snapshot_stage'] = func.__name__
+
+                PROFILE_STATE['snapshot_time'] += time.perf_counter() - snapshot_start
+                PROFILE_STATE['profiler'].enable()
+    return wrapper
+
 def setup_boto() -> None:
     """Does a global setup for the boto3 library to communicate with AWS S3"""
+    import boto3
+    boto3.compat.filter_python_deprecation_warnings()
 
     boto3.setup_default_session(aws_access_key_id=os.getenv("aws_access_key_id"),
                                 aws_secret_access_key=os.getenv("aws_secret_access_key"),
@@ -581,107 +670,364 @@ def export_asset_view_results_flattened_to_csv(data:dict, filename:str):
 
 def write_to_s3(bucket_name: str, file_path: str, local_file: dict) -> None:
     """Uses the boto3 library to write to an s3 bucket"""
+    import boto3
     s3 = boto3.resource('s3')
     bucket = bucket_name
     s3.meta.client.upload_file(f"TEMP/{local_file.split('/')[-1]}", bucket, file_path)
 
-# ROUTING FUNCTIONS
-def retrieve_data(config: JobConfig) -> dict:
-    """A routing script that will take the data type and name from the config.csv and get the appropriate data for the jobs"""
-    if config.tanium_type == "report":
-        log("info", "type: report")
-        target_report = find_asset_report_by_name(config.tanium_component_name)
+# FILE WRITER REGISTRATIONS
+register_file_writer("report", "csv")(export_asset_report_results_to_csv)
+register_file_writer("report", "json")(export_to_json)
+register_file_writer("view", "csv")(export_asset_view_results_to_csv)
+register_file_writer("question", "csv")(export_saved_question_results_to_csv)
+register_file_writer("question", "json")(export_to_json)
+
+@register_file_writer("view", "json")
+def export_asset_view_results_to_json(data: dict, destination: str) -> None:
+    """Writes only the results of an asset view to a json file on the local drive"""
+    export_to_json(data['results'], destination)
+
+# SOURCES
+@register_source("report")
+def retrieve_asset_report(config: JobConfig) -> dict:
+    """Finds the configured asset report by name and returns its query results"""
+    log("info", "type: report")
+    target_report = find_asset_report_by_name(config.tanium_component_name)
+
+    if not target_report:
+        log("error", "Under type report, no report was found")
+        return None
 
-        if not target_report:
-            log("error", "Under type report, no report was found")
-            return None
+    query_report = query_asset_report(target_report['id'])
+
+    if not query_report:
+        log("error", "Unable to gather report results")
+        return None
+    
+    return query_report
 
-        query_report = query_asset_report(target_report['id'])
+@register_source("view")
+def retrieve_asset_view(config: JobConfig) -> dict:
+    """Finds the configured asset view by name and returns the view alongside its results"""
+    target_view = get_asset_view_by_name(config.tanium_component_name)
 
-        if not query_report:
-            log("error", "Unable to gather report results")
-            return None
-        
-        return query_report
+    if not target_view:
+        log("error", "Under type view, no view was found")
+        return None
     
-    elif config.tanium_type == "view":
-        target_view = get_asset_view_by_name(config.tanium_component_name)
+    query_view = get_asset_view_results(target_view['id'])
 
-        if not target_view:
-            log("error", "Under type view, no view was found")
-            return None
-        
-        query_view = get_asset_view_results(target_view['id'])
+    if not query_view:
+        log("error", "Unable to gather asset view results")
+        return None
+    
+    return {'view': target_view, 'results': query_view}
 
-        if not query_view:
-            log("error", "Unable to gather asset view results")
-            return None
-        
-        return {'view': target_view, 'results': query_view}
-        
+@register_source("question")
+def retrieve_saved_question(config: JobConfig) -> dict:
+    """Finds the configured saved question by name and returns its results"""
+    question_id = get_saved_question_id_by_name(config.tanium_component_name)
+
+    if not question_id:
+        return None
+    
+    question_results = get_saved_question_results(question_id)
+
+    if not question_results:
+        return None
+    
+    return question_results
+
+# SINKS
+@register_sink("s3", setup=setup_boto)
+def export_to_s3(data: dict, config: JobConfig) -> None:
+    """Generates the file locally and uploads it to the configured s3 bucket"""
+    temp_file_location = f"TEMP/{config.file_location.split('/')[-1]}"
+    generate_file(config, data)
+    log("info", "type: s3, writing to s3...")
+    write_to_s3(config.bucket_name, config.file_location, temp_file_location)
+    # Add delete local file for s3
+
+@register_sink("file")
+def export_to_file(data: dict, config: JobConfig) -> None:
+    """Generates the file at the configured file location"""
+    generate_file(config, data)
+    log("info", "type: file, exporting the results...")
+
+@register_sink("splunk")
+def export_to_splunk(data: dict, config: JobConfig) -> None:
+    """Sends the data to the Splunk HTTP Event Collector"""
+    if config.tanium_type == "view":
+        send_asset_view_to_splunk(data)
+    elif config.tanium_type == "report":
+        send_asset_report_to_splunk(data)
     elif config.tanium_type == "question":
-        question_id = get_saved_question_id_by_name(config.tanium_component_name)
+        send_saved_questions_to_splunk(data)
 
-        if not question_id:
-            return None
-        
-        question_results = get_saved_question_results(question_id)
+# ROUTING FUNCTIONS
+@timed_stage
+def retrieve_data(config: JobConfig) -> dict:
+    """A routing script that will take the data type and name from the config.csv and get the appropriate data for the jobs"""
+    source = SOURCES.get(config.tanium_type)
 
-        if not question_results:
-            return None
-        
-        return question_results
+    if not source:
+        log("warning", f"An invalid form of data was assigned to gather. Unable to retrieve {config.tanium_type} from Tanium Server. Currently only support {', '.join(SOURCES)} ")
+        return None
 
-    else:
-        log("warning", f"An invalid form of data was assigned to gather. Unable to retrieve {type} from Tanium Server. Currently only support 'asset' and 'question' ")
+    return source(config)
 
+@timed_stage
 def generate_file(config: JobConfig, data: dict) -> str:
-    if config.tanium_type == "report":
-        if config.flatten != '' and config.file_format == "csv":
-            export_asset_view_results_flattened_to_csv(data, config.file_location)
-        if config.file_format == "csv":
-            export_asset_report_results_to_csv(data, config.file_location)
-        if config.file_format == "json":
-            export_to_json(data, config.file_location)
-    
-    if config.tanium_type == "view":
-        if config.file_format == "csv":
-            export_asset_view_results_to_csv(data, config.file_location)
-        if config.file_format == "json":
-            export_to_json(data['results'], config.file_location)
+    """Routing function that writes the data to the configured file location using the registered file writer"""
+    writer = FILE_WRITERS.get((config.tanium_type, config.file_format))
 
-    if config.tanium_type == "question": 
-        if config.file_format == "csv":
-            export_saved_question_results_to_csv(data, config.file_location)
+    if not writer:
+        log("warning", f"No file writer is available for {config.tanium_type} in the {config.file_format} format")
+        return None
 
-        if config.file_format == "json":
-            export_to_json(data, config.file_location)
+    writer(data, config.file_location)
 
+@timed_stage
 def export_data(data: dict, config: JobConfig):
     """Routing function to generate the specified file and copy it to the specified location"""
     print(config.destination_type)
-    if config.destination_type == "s3":
-        temp_file_location = f"TEMP/{config.file_location.split('/')[-1]}"
-        generate_file(config, data)
-        log("info", "type: s3, writing to s3...")
-        write_to_s3(config.bucket_name, config.file_location, temp_file_location)
-        # Add delete local file for s3
-    elif config.destination_type == "file":
-        generate_file(config, data)
-        log("info", "type: file, exporting the results...")
-    elif config.destination_type == "splunk":
-        if config.tanium_type == "view":
-            send_asset_view_to_splunk(data)
-        elif config.tanium_type == "report":
-            send_asset_report_to_splunk(data)
-        elif config.tanium_type == "question":
-            send_saved_questions_to_splunk(data)
+    sink = SINKS.get(config.destination_type)
 
-    else:
-        log("warning", f"An invalid form of data was assigned to the destination type. Unable to export to {config.destination_type}. Currently only support 's3' and 'file' ")
+    if not sink:
+        log("warning", f"An invalid form of data was assigned to the destination type. Unable to export to {config.destination_type}. Currently only support {', '.join(SINKS)} ")
+        return
+
+    init_sink(config.destination_type)
+    sink(data, config)
+
+class LeaseStore:
+    def __init__(self, path: str, node_id: str, lease_ttl: int, node_ttl: int, member: bool = True):
+        """Opens the shared SQLite lease table used to coordinate jobs between several Repeater nodes. Claims rely on SQLite's
+        POSIX file locks, so the database must be on a filesystem where those locks work across hosts"""
+        # Imported here rather than at the top of the file so runs without --lease-db don't pay for them
+        import sqlite3
+        import uuid
+
+        self.path      = path
+        self.node_id   = node_id
+        # node_id only decides affinity. Leases are held by this process alone, so an overlapping run on the same
+        # node can't take over jobs that this run is still exporting
+        self.owner     = f"{node_id}:{os.getpid()}:{uuid.uuid4().hex}"
+        self.lease_ttl = lease_ttl
+        self.node_ttl  = node_ttl
+        # Nodes that only run a few named jobs are not members, so rendezvous hashing never hands them other jobs
+        self.member    = member
+
+        # Autocommit mode so that every claim can take the write lock up front with BEGIN IMMEDIATE
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS nodes (node_id TEXT PRIMARY KEY, heartbeat REAL NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS leases (job_name TEXT PRIMARY KEY, owner TEXT, expires REAL NOT NULL DEFAULT 0, last_run TEXT NOT NULL DEFAULT '')")
+        self.heartbeat()
+
+    def heartbeat(self, connection: 'sqlite3.Connection' = None) -> None:
+        """Marks this node as alive so that it keeps its share of the jobs"""
+        if not self.member:
+            return
+
+        (connection or self.connection).execute("INSERT INTO nodes (node_id, heartbeat) VALUES (?, ?) ON CONFLICT(node_id) DO UPDATE SET heartbeat = excluded.heartbeat", (self.node_id, time.time()))
+
+    def live_nodes(self) -> list:
+        """Returns every node that has sent a heartbeat within the node ttl"""
+        rows = self.connection.execute("SELECT node_id FROM nodes WHERE heartbeat >= ?", (time.time() - self.node_ttl,))
+        return [row[0] for row in rows]
+
+    def preferred_node(self, job_name: str) -> str:
+        """Uses rendezvous hashing to pick the live node a job has affinity for, so jobs only move when nodes join or die"""
+        import hashlib
+        nodes = self.live_nodes() or [self.node_id]
+        return max(nodes, key=lambda node: hashlib.sha256(f"{node}:{job_name}".encode()).hexdigest())
+
+    def last_run(self, job_name: str) -> str:
+        """Returns the last run of a job recorded by any node, or an empty string if it has never run"""
+        row = self.connection.execute("SELECT last_run FROM leases WHERE job_name = ?", (job_name,)).fetchone()
+        return row[0] if row else ""
+
+    def claim(self, job_config: JobConfig, force: bool = False) -> bool:
+        """Atomically takes the lease for a due job. Returns False if another node holds it, already ran it, or has affinity for it.
+        A forced claim, used for jobs named with --job, ignores affinity and the last run but still never takes a lease another node holds"""
+        import sqlite3
+        self.heartbeat()
+        if not force and self.preferred_node(job_config.job_name) != self.node_id:
+            return False
+
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.connection.execute("SELECT owner, expires, last_run FROM leases WHERE job_name = ?", (job_config.job_name,)).fetchone()
+
+            if row:
+                owner, expires, last_run = row
+                if owner and owner != self.owner and expires > now:
+                    self.connection.execute("ROLLBACK")
+                    return False
+
+                if not force and not is_due(last_run, job_config.frequency):
+                    self.connection.execute("ROLLBACK")
+                    return False
+
+            self.connection.execute("INSERT INTO leases (job_name, owner, expires) VALUES (?, ?, ?) ON CONFLICT(job_name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires", (job_config.job_name, self.owner, now + self.lease_ttl))
+            self.connection.execute("COMMIT")
+
+        except sqlite3.Error:
+            self.connection.execute("ROLLBACK")
+            raise
+
+        return True
+
+    def renew(self, job_name: str, connection: 'sqlite3.Connection' = None) -> bool:
+        """Extends a held lease, returning False if another node has taken it over"""
+        connection = connection or self.connection
+        self.heartbeat(connection)
+        cursor = connection.execute("UPDATE leases SET expires = ? WHERE job_name = ? AND owner = ?", (time.time() + self.lease_ttl, job_name, self.owner))
+
+        if cursor.rowcount == 0:
+            log("warning", f"the lease for {job_name} was taken over by another node while this node was still running it")
+            return False
+
+        return True
+
+    @contextlib.contextmanager
+    def keep_alive(self, job_name: str):
+        """Renews a held lease from a background thread every third of the lease ttl for as long as the job runs"""
+        import sqlite3
+        import threading
+        stop = threading.Event()
+
+        def renew_until_stopped():
+            # SQLite connections can't be shared between threads, so the renewals use their own
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            try:
+                while not stop.wait(self.lease_ttl / 3):
+                    try:
+                        self.renew(job_name, connection)
+
+                    except sqlite3.Error as error:
+                        log("error", f"Unable to renew the lease for {job_name}, another node may take it over once it expires")
+                        log("debug", f"Error thrown: {error}")
+
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=renew_until_stopped, daemon=True)
+        thread.start()
+        try:
+            yield
+
+        finally:
+            stop.set()
+            thread.join()
+
+    def release(self, job_name: str, last_run: str = "") -> bool:
+        """Gives up a held lease, recording the last run if the job completed. Returns False if the lease was lost to another node"""
+        if last_run:
+            cursor = self.connection.execute("UPDATE leases SET owner = NULL, expires = 0, last_run = ? WHERE job_name = ? AND owner = ?", (last_run, job_name, self.owner))
+        else:
+            cursor = self.connection.execute("UPDATE leases SET owner = NULL, expires = 0 WHERE job_name = ? AND owner = ?", (job_name, self.owner))
+
+        if cursor.rowcount == 0:
+            log("warning", f"the lease for {job_name} was lost to another node before it was released, its Last Run of {last_run or 'this attempt'} was not recorded in the lease table")
+            return False
+
+        return True
+
+    def close(self) -> None:
+        self.connection.close()
+
+def is_due(last_run: str, frequency: str) -> bool:
+    """Checks whether a job with the given last run and frequency in hours should run now"""
+    if not last_run:
+        return True
+
+    return datetime.now() - datetime.strptime(last_run, TIMESTAMP_FORMAT) >= timedelta(hours=int(frequency))
+
+def run_job(job_config: JobConfig) -> bool:
+    """Retrieves and exports the data for a single job, returning whether it completed"""
+    data = retrieve_data(job_config)
+    if not data:
+        log('warning', f"Data was not returned when requesting {job_config.tanium_type}: {job_config.tanium_component_name}")
+        return False
+
+    export_data(data, job_config)
+
+    job_config.last_run = datetime.now().strftime(TIMESTAMP_FORMAT)
+    return True
+
+def profile_job(job_config: JobConfig, profile_dir: str, top: int) -> bool:
+    """Runs a single job under cProfile and tracemalloc and writes a profile file and a report of stage timings and top allocations"""
+    # Imported here rather than at the top of the file so runs without --profile don't pay for them
+    import cProfile
+    import pstats
+    import tracemalloc
+
+    global PROFILE_STATE
+    profiler = cProfile.Profile()
+    PROFILE_STATE = {'timings': {}, 'depth': 0, 'profiler': profiler, 'snapshot': None, 'snapshot_size': 0, 'snapshot_stage': None, 'snapshot_time': 0}
+
+    os.makedirs(profile_dir, exist_ok=True)
+    file_prefix = os.path.join(profile_dir, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', job_config.job_name)}-{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        completed = run_job(job_config)
+
+    finally:
+        profiler.disable()
+        total = time.perf_counter() - start - PROFILE_STATE['snapshot_time']
+        peak = tracemalloc.get_traced_memory()[1]
+        snapshot = PROFILE_STATE['snapshot'] or tracemalloc.take_snapshot()
+        snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        tracemalloc.stop()
+        state = PROFILE_STATE
+        PROFILE_STATE = None
+
+        profiler.dump_stats(f"{file_prefix}.prof")
+
+        with open(f"{file_prefix}.txt", "w") as report:
+            report.write(f"Job: {job_config.job_name} ({job_config.tanium_type}: {job_config.tanium_component_name} -> {job_config.destination_type})\n")
+            report.write(f"Total: {total:.3f}s (excluding {state['snapshot_time']:.3f}s taking allocation snapshots), peak traced memory: {peak / 1024 / 1024:.1f} MiB\n\n")
+
+            # generate_file runs inside export_data for file and s3 destinations, so its time is also part of export_data
+            report.write("Stage timings\n")
+            for stage in ("retrieve_data", "generate_file", "export_data"):
+                report.write(f"  {stage:<15} {state['timings'].get(stage, 0):10.3f}s\n")
+
+            report.write(f"\nTop {top} allocations (at the end of {state['snapshot_stage'] or 'the job'})\n")
+            for stat in snapshot.statistics("lineno")[:top]:
+                report.write(f"  {stat}\n")
+
+            report.write(f"\nTop {top} functions by cumulative time\n")
+            pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(top)
+
+        log("info", f"profile for {job_config.job_name} written to {file_prefix}.prof and {file_prefix}.txt")
+
+    return completed
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Exports Tanium data on the schedule configured in config.txt")
+    parser.add_argument("--lease-db", help="path to a shared SQLite lease table on a filesystem with working POSIX locks; enables distributed mode so several nodes can split the jobs")
+    parser.add_argument("--node-id", default=socket.gethostname(), help="unique name of this node in distributed mode (default: hostname)")
+    parser.add_argument("--lease-ttl", type=int, default=3600, help="seconds a claimed job stays leased before another node may take it over (default: 3600)")
+    parser.add_argument("--node-ttl", type=int, default=10800, help="seconds without a heartbeat before a node is treated as dead and its jobs are reassigned; nodes only heartbeat while a run is in progress, so keep this at two to three times the interval between runs (default: 10800, for hourly runs)")
+    parser.add_argument("--job", action="append", help="only run the job with this name, even if it is not due; can be given more than once")
+    parser.add_argument("--profile", action="store_true", help="run each job under cProfile and tracemalloc and write a profile report per job")
+    parser.add_argument("--profile-dir", default="profiles", help="directory the profile files are written to (default: profiles)")
+    parser.add_argument("--profile-top", type=int, default=25, help="number of allocations and functions listed in each profile report (default: 25)")
+    args = parser.parse_args()
+
+    log("info", f"startup took {time.perf_counter() - STARTUP_BEGIN:.3f} seconds")
+
+    lease_store = None
+    if args.lease_db:
+        log("info", f"distributed mode enabled as node {args.node_id} using lease table {args.lease_db}")
+        lease_store = LeaseStore(args.lease_db, args.node_id, args.lease_ttl, args.node_ttl, member=not args.job)
 
-if __name__ == '__main__':
-    setup_boto()
     updated_entries = []
     with open(CONFIG_FILE, 'r') as file:
         reader = csv.DictReader(file)
@@ -690,29 +1036,58 @@ if __name__ == '__main__':
             job_config = JobConfig(row)
             print(job_config)
             print(job_config.dump())
-            last_run   = datetime.strptime(job_config.last_run, "%Y-%m-%d %H:%M:%S") if job_config.last_run else ""
-            frequency  = timedelta(hours=int(job_config.frequency))
-            if last_run == "" or datetime.now() - last_run >= frequency:
 
-                data = retrieve_data(job_config)
-                if not data:
-                    log('warning', f"Data was not returned when requesting {row['Tanium Type']}: {row['Component Name']}")
+            if args.job and job_config.job_name not in args.job:
+                updated_entries.append(row)
+                continue
+
+            if lease_store:
+                # Another node may have run the job since config.txt was last written
+                job_config.last_run = max(job_config.last_run, lease_store.last_run(job_config.job_name))
+
+            # Jobs named with --job run even when they are not due, so a job can be profiled or rerun on demand
+            if args.job or is_due(job_config.last_run, job_config.frequency):
+                if lease_store and not lease_store.claim(job_config, force=bool(args.job)):
+                    log("info", f"skipping {job_config.job_name}, it is leased to or was run by another node")
+                    updated_entries.append( job_config.dump() )
+                    continue
+
+                with lease_store.keep_alive(job_config.job_name) if lease_store else contextlib.nullcontext():
+                    if args.profile:
+                        completed = profile_job(job_config, args.profile_dir, args.profile_top)
+                    else:
+                        completed = run_job(job_config)
+
+                if lease_store:
+                    lease_store.release(job_config.job_name, job_config.last_run if completed else "")
+
+                if not completed:
                     updated_entries.append(row)
                     continue
-        
-                export_data(data, job_config)
-                
-                job_config.last_run = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
             updated_entries.append( job_config.dump() )
 
+    if lease_store:
+        # Pick up runs that other nodes finished while this node was working through the jobs
+        for entry in updated_entries:
+            entry['Last Run'] = max(entry['Last Run'], lease_store.last_run(entry['Name']))
 
-    # Overwrite the CSV file with the updated values
-    with open(CONFIG_FILE, 'w', newline='') as file:
-        fieldnames = ['Name', 'Destination Type', 'File Location', 'Frequency', 'Last Run', 'Tanium Type', 'Component Name', 'File Format', 'Bucket Name', 'Flatten', 'Overwrite']
-        
-        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        lease_store.close()
+
+    # Overwrite the CSV file with the updated values. The rows are written to a temp file next to it and swapped in,
+    # so another node reading config.txt never sees it truncated or half written
+    temp_config_file = f"{CONFIG_FILE}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(temp_config_file, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=CONFIG_FIELDNAMES)
         writer.writeheader()
 
         for entry in updated_entries:
-            writer.writerow(entry)
\ No newline at end of file
+            writer.writerow(entry)
+
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(temp_config_file, CONFIG_FILE)
+
+if __name__ == '__main__':
+    main()